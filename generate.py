@@ -1,9 +1,35 @@
 # OpenTiny - Open Source Static Tiny URL Shorter
 # Usage: python generate.py -j url.json -o _site -t template.html --error-page 404.html
 import os
+import re
+import sys
 import json
+import mmap
+import time
 import shutil
+import hashlib
 import argparse
+import itertools
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+import ijson
+
+# Path separator as bytes, for building output paths without os.path.join
+path_sep = os.sep.encode()
+
+# Pattern matching the placeholders supported by the template
+placeholder_pattern = re.compile(r'\{\{\s*(title|heading|url|description|image)\s*\}\}')
+
+# Function to split the template into literal chunks and placeholder slots
+def split_template(template_content):
+    # Even indices are literal text, odd indices are placeholder names
+    chunks = placeholder_pattern.split(template_content)
+    slots = [(i, chunks[i]) for i in range(1, len(chunks), 2)]
+    # Pre-encode the literal chunks once so each render only encodes the
+    # short per-entry values, not the whole template body
+    tokens = [chunk.encode('utf-8') for chunk in chunks]
+    return tokens, slots
 
 # Function to parse command-line arguments
 def parse_arguments():
@@ -22,6 +48,18 @@ def parse_arguments():
                         help="Sitemap file path (default: sitemap.xml)")
     parser.add_argument('-p', '--print', type=bool, default=True,
                         help="Print details of the generated files (default: True)")
+    parser.add_argument('--clean', action='store_true',
+                        help="Remove the parent folder first and rebuild everything from scratch")
+    parser.add_argument('--verbose-dump', action='store_true',
+                        help="Pretty-print the full contents of the JSON file before building")
+    parser.add_argument('--watch', action='store_true',
+                        help="Keep running and rebuild whenever the input files change")
+    parser.add_argument('--no-sitemap', action='store_true',
+                        help="Skip sitemap generation (also skips loading the config file)")
+    parser.add_argument('--redirects-mode', type=str, default='static-html',
+                        choices=['static-html', 'netlify', 'apache'],
+                        help="Output format: one HTML page per key, a Netlify _redirects "
+                             "file, or an Apache .htaccess file (default: static-html)")
     return parser.parse_args()
 
 # Function to load the base URL from config file
@@ -32,121 +70,305 @@ def load_config(config_file):
             return config
     except FileNotFoundError:
         print(f"Warning: The configuration file '{config_file}' does not exist. Using empty base URL.")
-        return ''
+        return {}
     except json.JSONDecodeError:
         print(f"Error: The file '{config_file}' is not a valid JSON file.")
-        return ''
+        return {}
 
-# Function to generate a sitemap
-def generate_sitemap(data, parent_folder, base_url):
-    sitemap_path = os.path.join(parent_folder, 'sitemap.xml')
-    pages = []
+# Function to load the build cache manifest from a previous run
+def load_build_cache(cache_path):
+    try:
+        with open(cache_path, 'r') as file:
+            return json.load(file)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
 
-    for key in data.keys():
-        pages.append(key)
+# Function to compute the hash of an entry combined with the template;
+# default=str covers the Decimal numbers the ijson streaming path yields
+def entry_hash(template_content, value):
+    payload = template_content + json.dumps(value, sort_keys=True, default=str)
+    return hashlib.sha1(payload.encode('utf-8')).hexdigest()
 
-    # Create the XML content for the sitemap
-    xml_content = '<?xml version="1.0" encoding="UTF-8"?>\n'
-    xml_content += '<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n'
-    for page in pages:
-        xml_content += f'  <url>\n\t\t<loc>{base_url}/{page}/</loc>\n\t</url>\n'
-    xml_content += '</urlset>'
+# Function to build the output file for a single entry
+def build_entry(key, value, parent_prefix, tokens, slots, template_content,
+                build_cache, new_cache, log, seen_payloads):
+    if 'url' not in value:
+        print(f"Error: The URL is required for '{key}'. Skipping this entry.")
+        return None  # Skip this entry if URL is not provided
 
-    # Write the sitemap to the file
-    with open(sitemap_path, 'w') as sitemap_file:
-        sitemap_file.write(xml_content)
-    return sitemap_path
+    # Extract optional fields with defaults
+    url = value['url']
+    title = value.get('title', key)
+    description = value.get('description', key)
+    image = value.get('image', '')
 
-# Main function
-def main():
-    # Parse command-line arguments
-    args = parse_arguments()
+    # Special case for the index key; paths are built as bytes off the
+    # precomputed parent prefix, skipping two os.path.join calls per entry
+    if key == "index":
+        index_file_path = parent_prefix + b'index.html'
+    else:
+        folder_path = parent_prefix + key.encode('utf-8')
+        index_file_path = folder_path + path_sep + b'index.html'
+
+    # Skip entries whose template and data are unchanged since the last run
+    key_hash = entry_hash(template_content, value)
+    new_cache[key] = key_hash
+    if build_cache.get(key) == key_hash and os.path.exists(index_file_path):
+        log(f"File '{os.fsdecode(index_file_path)}' unchanged, skipped.")
+        return index_file_path
+
+    # Create a folder for the key; plain mkdir is cheaper than makedirs
+    # for the flat common case, with a fallback for nested keys
+    if key != "index":
+        try:
+            os.mkdir(folder_path)
+        except FileExistsError:
+            pass
+        except FileNotFoundError:
+            os.makedirs(folder_path, exist_ok=True)
+
+    # Fill the placeholder slots and join the chunks in a single pass
+    values = {'title': title, 'heading': title, 'url': url,
+              'description': description, 'image': image}
+    parts = tokens.copy()
+    for i, name in slots:
+        parts[i] = values[name].encode('utf-8')
+    index_content = b''.join(parts)
+
+    # Deduplicate identical payloads: hardlink later copies to the first
+    # file instead of writing the same bytes again (setdefault is atomic)
+    payload_hash = hashlib.blake2b(index_content, digest_size=16).digest()
+    first_path = seen_payloads.setdefault(payload_hash, index_file_path)
+    if first_path != index_file_path:
+        try:
+            if os.path.exists(index_file_path):
+                os.remove(index_file_path)
+            os.link(first_path, index_file_path)
+            log(f"File '{os.fsdecode(index_file_path)}' linked to '{os.fsdecode(first_path)}'")
+            return index_file_path
+        except OSError:
+            pass  # Source not written yet or filesystem without hardlinks
+
+    # Write to a temp file through a raw fd and rename it over index.html:
+    # the rename is atomic and replaces the inode, so rewriting an entry
+    # never truncates a sibling that was hardlinked to it on an earlier run
+    temp_file_path = index_file_path + b'.tmp'
+    fd = os.open(temp_file_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        os.write(fd, index_content)
+    finally:
+        os.close(fd)
+    os.rename(temp_file_path, index_file_path)
+    log(f"File '{os.fsdecode(index_file_path)}' created")
+    return index_file_path
+
+# Function to run one build; state carries the split template and the build
+# cache between rebuilds in watch mode
+def rebuild(args, state):
     json_file = args.json_file
     parent_folder = args.parent_folder
     template_file = args.template_file
     error_page_file = args.error_page
     print_details = args.print
+    # Detail messages are collected here and flushed with a single write at
+    # the end of the build; list.append is atomic, so the workers need no lock
+    log_lines = []
+    # When details are off, log is a no-op callable, so the call sites need
+    # no per-entry branch on print_details
+    log = log_lines.append if print_details else (lambda *args, **kwargs: None)
+    # Map of rendered-payload hash -> first output path, for hardlink dedup
+    seen_payloads = {}
+    # Output paths are composed from this byte prefix in the hot loop
+    parent_prefix = parent_folder.encode('utf-8') + path_sep
     sitemap_path = args.sitemap
 
-    # Load base URL from config file
-    config = load_config(args.config_file)
-    base_url = config.get('base_url', '')
+    # Load base URL from config file; only the sitemap needs it, so skip
+    # the config read entirely when the sitemap is disabled
+    if args.no_sitemap:
+        base_url = ''
+    else:
+        config = load_config(args.config_file)
+        base_url = config.get('base_url', '')
+
+    # Remove the parent folder only when a clean rebuild is requested;
+    # rm -rf iterates the tree natively and beats shutil.rmtree on big sites
+    if args.clean and os.path.exists(parent_folder):
+        if sys.platform != 'win32':
+            subprocess.run(['rm', '-rf', parent_folder], check=True)
+        else:
+            shutil.rmtree(parent_folder, ignore_errors=True)
+        log(f"Folder '{parent_folder}' removed.")
 
-    # Remove the parent folder if it exists, then recreate it
-    if os.path.exists(parent_folder):
-        shutil.rmtree(parent_folder)
-        if print_details: 
-            print(f"Folder '{parent_folder}' removed.")
-        
-    os.makedirs(parent_folder)
-    if print_details: 
-        print(f"Folder '{parent_folder}' created.")
+    os.makedirs(parent_folder, exist_ok=True)
+    log(f"Folder '{parent_folder}' ready.")
+
+    # Load the build cache from the previous run to skip unchanged entries;
+    # in watch mode the cache from the last rebuild is reused directly
+    cache_path = os.path.join(parent_folder, '.build-cache.json')
+    build_cache = state.get('build_cache')
+    if build_cache is None:
+        build_cache = load_build_cache(cache_path)
+    new_cache = {}
 
     # Copy the 404.html file into the _site folder
     if os.path.exists(error_page_file):
         shutil.copy(error_page_file, parent_folder)
-        if print_details: 
-            print(f"File '{error_page_file}' copied to '{parent_folder}'.")
+        log(f"File '{error_page_file}' copied to '{parent_folder}'.")
     else:
         print(f"Warning: The file '{error_page_file}' does not exist. It was not copied.")
 
     # Read the JSON file
     try:
-        with open(json_file, 'r') as file:
-            data = json.load(file)
-            if print_details: 
+        with open(json_file, 'rb') as file:
+            if print_details and args.verbose_dump:
+                # Load the full dict so the contents can be displayed; orjson
+                # parses and re-serializes several times faster than stdlib
+                # json, and is only needed (and imported) on this path
+                import orjson
+                data = orjson.loads(file.read())
                 print(f"Contents of {json_file}:")
-                print(json.dumps(data, indent=4))
-            
-            # Read the template file
-            with open(template_file, 'r') as template:
-                template_content = template.read()
-
-            # Create a folder and an index.html file for each key in the JSON data
-            for key, value in data.items():
-                if 'url' not in value:
-                    print(f"Error: The URL is required for '{key}'. Skipping this entry.")
-                    continue  # Skip this entry if URL is not provided
-
-                # Extract optional fields with defaults
-                url = value['url']
-                title = value.get('title', key)
-                description = value.get('description', key)
-                image = value.get('image', '')
-
-                # Special case for the index key
-                if key == "index":
-                    index_file_path = os.path.join(parent_folder, 'index.html')
+                print(orjson.dumps(data, option=orjson.OPT_INDENT_2).decode())
+                entries = iter(data.items())
+            else:
+                # Stream key/value pairs without building the full dict
+                entries = ijson.kvitems(file, '')
+
+            # Read the template file and compile it once; the redirects modes
+            # emit a single manifest file and never touch the template
+            if args.redirects_mode == 'static-html':
+                # Re-read and re-split the template only when it changed on
+                # disk; watch-mode rebuilds reuse the resident copy
+                template_mtime = os.stat(template_file).st_mtime
+                if state.get('template_mtime') != template_mtime:
+                    # Memory-map the template: repeated runs read straight
+                    # from the warm page cache, zero-copy (an empty file
+                    # cannot be mapped, so fall back to a plain read)
+                    with open(template_file, 'rb') as template:
+                        if os.fstat(template.fileno()).st_size == 0:
+                            template_content = ''
+                        else:
+                            with mmap.mmap(template.fileno(), 0, access=mmap.ACCESS_READ) as template_map:
+                                template_content = template_map[:].decode('utf-8')
+                    state['template_content'] = template_content
+                    state['tokens'], state['slots'] = split_template(template_content)
+                    state['template_mtime'] = template_mtime
+                template_content = state['template_content']
+                tokens, slots = state['tokens'], state['slots']
+
+            # Write the sitemap while the entries stream through the build loop;
+            # the buffered handle turns the per-entry writes into a few big ones
+            sitemap_file = None
+            if not args.no_sitemap:
+                sitemap_file_path = os.path.join(parent_folder, sitemap_path)
+                sitemap_file = open(sitemap_file_path, 'w', buffering=1 << 20)
+                sitemap_file.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+                sitemap_file.write('<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n')
+
+            try:
+                # The executor pulls entries from this generator in the main
+                # thread, so the sitemap writes stay serial
+                def tracked_entries():
+                    for key, value in entries:
+                        if sitemap_file is not None:
+                            sitemap_file.write(f'  <url>\n\t\t<loc>{base_url}/{key}/</loc>\n\t</url>\n')
+                        yield key, value
+
+                if args.redirects_mode == 'static-html':
+                    # Build a folder and an index.html file for each key in parallel;
+                    # each entry renders a small string and writes one independent
+                    # file. Entries are submitted in bounded batches - map() would
+                    # drain the whole stream into futures up front, losing the
+                    # memory bound the ijson streaming parse provides
+                    max_workers = min(32, (os.cpu_count() or 4) * 4)
+                    entry_iter = tracked_entries()
+                    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                        while True:
+                            batch = list(itertools.islice(entry_iter, max_workers * 4))
+                            if not batch:
+                                break
+                            list(executor.map(
+                                lambda item: build_entry(item[0], item[1], parent_prefix, tokens,
+                                                         slots, template_content, build_cache,
+                                                         new_cache, log, seen_payloads),
+                                batch))
                 else:
-                    # Create a folder for the key
-                    folder_path = os.path.join(parent_folder, key)
-                    if not os.path.exists(folder_path):
-                        os.makedirs(folder_path)
-                        if print_details: print(f"Folder '{folder_path}' created.")
+                    # Collapse all redirects into one manifest file: a single
+                    # write instead of a folder and an HTML file per key
+                    redirects_name = '_redirects' if args.redirects_mode == 'netlify' else '.htaccess'
+                    redirects_path = os.path.join(parent_folder, redirects_name)
+                    with open(redirects_path, 'w') as redirects_file:
+                        for key, value in tracked_entries():
+                            if 'url' not in value:
+                                print(f"Error: The URL is required for '{key}'. Skipping this entry.")
+                                continue
+                            path = '/' if key == "index" else f'/{key}'
+                            if args.redirects_mode == 'netlify':
+                                redirects_file.write(f"{path} {value['url']} 302\n")
+                            else:
+                                pattern = '^/$' if key == "index" else f'^{path}/?$'
+                                redirects_file.write(f"RedirectMatch 302 {pattern} {value['url']}\n")
+                    log(f"Redirects written to '{redirects_path}'")
+            finally:
+                if sitemap_file is not None:
+                    sitemap_file.write('</urlset>')
+                    sitemap_file.close()
+            if sitemap_file is not None:
+                log(f"Sitemap generated at '{sitemap_file_path}'")
+
+            # Remove output for entries that disappeared from the JSON file
+            for key in build_cache:
+                if key not in new_cache:
+                    if key == "index":
+                        stale_path = os.path.join(parent_folder, 'index.html')
+                        if os.path.exists(stale_path):
+                            os.remove(stale_path)
                     else:
-                        if print_details: print(f"Folder '{folder_path}' already exists.")
-                        # Create index.html in the folder from the template
-                    index_file_path = os.path.join(folder_path, 'index.html')
-
-                # Replace placeholders in the template
-                index_content = template_content.replace('{{ title }}', title) \
-                                                .replace('{{ heading }}', title) \
-                                                .replace('{{ url }}', url) \
-                                                .replace('{{ description }}', description) \
-                                                .replace('{{ image }}', image)
-                # Write to index.html, overwriting if it exists
-                with open(index_file_path, 'w') as index_file:
-                    index_file.write(index_content)
-                if print_details: print(f"File '{index_file_path}' created")
-
-            # Generate the sitemap after creating all the pages
-            sitemap_path = generate_sitemap(data, parent_folder, base_url)
-            if print_details: print(f"Sitemap generated at '{sitemap_path}'")
+                        shutil.rmtree(os.path.join(parent_folder, key), ignore_errors=True)
+                    log(f"Stale entry '{key}' removed.")
+
+            # Persist the build cache for the next run
+            state['build_cache'] = new_cache
+            with open(cache_path, 'w') as cache_file:
+                json.dump(new_cache, cache_file)
 
     except FileNotFoundError as e:
         print(f"Error: {e}")
-    except json.JSONDecodeError:
+    except (json.JSONDecodeError, ijson.JSONError):
         print(f"Error: The file '{json_file}' is not a valid JSON file.")
 
+    # Flush the collected detail messages with one write
+    if log_lines:
+        print('\n'.join(log_lines))
+
+# Main function
+def main():
+    # Parse command-line arguments
+    args = parse_arguments()
+    state = {}
+    rebuild(args, state)
+
+    if not args.watch:
+        return
+
+    # Poll the input files and rebuild whenever one of them changes; the
+    # split template and the build cache stay resident between rebuilds
+    watched_files = [args.json_file, args.template_file, args.config_file]
+
+    def snapshot():
+        return tuple(os.stat(path).st_mtime if os.path.exists(path) else None
+                     for path in watched_files)
+
+    print(f"Watching {', '.join(watched_files)} for changes (Ctrl+C to stop).")
+    last_snapshot = snapshot()
+    try:
+        while True:
+            time.sleep(0.5)
+            current_snapshot = snapshot()
+            if current_snapshot != last_snapshot:
+                last_snapshot = current_snapshot
+                rebuild(args, state)
+    except KeyboardInterrupt:
+        pass
+
 if __name__ == "__main__":
     main()